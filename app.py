@@ -1,27 +1,76 @@
 import os
+from datetime import datetime
+from functools import cached_property
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, url_for,
+    make_response, abort)
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import select, literal, delete, func, true, tuple_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, selectinload
 
 from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, EditUserForm
-from models import db, connect_db, User, Message, Likes, Follows
+from models import db, connect_db, cache, User, Message, Likes, Follows
 
 CURR_USER_KEY = "curr_user"  # this is the key in the session
+USER_SEARCH_LIMIT = 50
+FEED_SIZE = 100
+DEFAULT_USER_IMAGE = User.image_url.default.arg
+
+
+class WarblerGlobals(_AppCtxGlobals):
+    """Flask `g` that only builds the CSRF-only form when something uses it
+    (POST handlers and templates with follow/like/logout buttons)."""
+
+    @cached_property
+    def csrf_form(self):
+        return CSRFProtectForm()
+
 
 app = Flask(__name__)
+app.app_ctx_globals_class = WarblerGlobals
 
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True  # originally False
+# Default pool (5 + 10 overflow) is too small under load; pre-ping and
+# recycle so dead Postgres connections get replaced instead of erroring.
+# For multi-worker deployments, put PgBouncer (transaction pooling) in front.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 25,
+    'max_overflow': 25,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+}
+# only log SQL when running with debug on (FLASK_DEBUG=1); it adds work
+# to every statement
+app.config['SQLALCHEMY_ECHO'] = app.debug
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
+
+# Redis when REDIS_URL is set. An in-process cache can only be cleared in
+# the worker that changed the data, so without Redis caching is off, except
+# in a single-process debug run.
+if 'REDIS_URL' in os.environ:
+    app.config['CACHE_TYPE'] = 'RedisCache'
+    app.config['CACHE_REDIS_URL'] = os.environ['REDIS_URL']
+elif app.debug:
+    app.config['CACHE_TYPE'] = 'SimpleCache'
+else:
+    app.config['CACHE_TYPE'] = 'NullCache'
+
+# the toolbar hooks every response (HTML injection, SQL/template capture),
+# so only install it when running with debug on (FLASK_DEBUG=1)
+if app.debug:
+    toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+cache.init_app(app)
 
 
 ##############################################################################
@@ -33,17 +82,24 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        user = User.get_by_id(session[CURR_USER_KEY])
+
+        # a cached user is detached; attach it without re-SELECTing it
+        g.user = db.session.merge(user, load=False) if user else None
 
     else:
         g.user = None
 
 
 @app.before_request
-def add_crsf_form_to_all_pages():
-    """Before every route, add CSRF-only form to global object"""
+def reset_csrf_form():
+    """Start each request without a CSRF form; g.csrf_form builds one bound
+    to this request on first use.
 
-    g.csrf_form = CSRFProtectForm()
+    `g` lives as long as the app context, which can outlast a request (e.g.
+    an app context pushed around the test client)."""
+
+    g.pop('csrf_form', None)
 
 
 def do_login(user):
@@ -52,6 +108,14 @@ def do_login(user):
     session[CURR_USER_KEY] = user.id
 
 
+def uncache_user(*user_ids):
+    """Drop cached copies of these users so the next request re-fetches."""
+
+    # get_by_id is a classmethod: Flask-Caching needs the class passed too
+    for user_id in user_ids:
+        cache.delete_memoized(User.get_by_id, User, user_id)
+
+
 def do_logout():
     """Logout user."""
 
@@ -79,7 +143,7 @@ def signup():
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=form.image_url.data or DEFAULT_USER_IMAGE,
             )
             db.session.commit()
 
@@ -137,7 +201,8 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username;
+    shows the closest USER_SEARCH_LIMIT matches.
     """
 
     search = request.args.get('q')
@@ -145,7 +210,12 @@ def list_users():
     if not search:
         users = User.query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = (User
+                 .query
+                 .filter(User.username.ilike(f"%{search}%"))
+                 .order_by(func.similarity(User.username, search).desc())
+                 .limit(USER_SEARCH_LIMIT)
+                 .all())
 
     return render_template('users/index.html', users=users)
 
@@ -156,7 +226,7 @@ def users_show(user_id):
 
     user = User.query.get_or_404(user_id)
 
-    return render_template('users/show.html', user=user)
+    return render_conditional('users/show.html', user=user)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -194,10 +264,26 @@ def add_follow(follow_id):
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
+        # existence check and insert in one statement: the follow row is
+        # only inserted if the user exists, and we get their name back
+        new_follow = (insert(Follows)
+                      .from_select(
+                          ["user_being_followed_id", "user_following_id"],
+                          select(User.id, literal(g.user.id))
+                          .where(User.id == follow_id))
+                      .on_conflict_do_nothing()
+                      .cte("new_follow"))
+        followed_username = db.session.scalar(
+            select(User.username)
+            .where(User.id == follow_id)
+            .add_cte(new_follow))
+
+        if followed_username is None:
+            abort(404)
+
         db.session.commit()
-        flash(f"You are now following {followed_user.username}!", "info")
+        uncache_user(g.user.id, follow_id)
+        flash(f"You are now following {followed_username}!", "info")
 
     return redirect(came_from_url)
 
@@ -216,6 +302,7 @@ def stop_following(follow_id):
         followed_user = User.query.get(follow_id)
         g.user.following.remove(followed_user)
         db.session.commit()
+        uncache_user(g.user.id, followed_user.id)
         flash(f"You've unfollowed {followed_user.username}.", "warning")
 
     return redirect(came_from_url)
@@ -234,13 +321,13 @@ def edit_profile():
     if form.validate_on_submit():
         g.user.email = form.email.data
         g.user.username = form.username.data
-        g.user.image_url = (form.image_url.data or
-                            "/static/images/default-pic.png")
+        g.user.image_url = form.image_url.data or DEFAULT_USER_IMAGE
         g.user.header_image_url = (form.header_image_url.data or
                                    "/static/images/warbler-hero.jpg")
         g.user.bio = form.bio.data
         if User.authenticate(g.user.username, form.password.data):
             db.session.commit()
+            uncache_user(g.user.id)
             flash("Profile successfully updated!", 'success')
             return redirect(f'/users/{g.user.id}')
         else:
@@ -271,12 +358,31 @@ def delete_user():
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        Message.query.filter_by(user_id=g.user.id).delete()
-        Follows.query.filter_by(user_being_followed_id=g.user.id).delete()
-        Follows.query.filter_by(user_following_id=g.user.id).delete()
-        Likes.query.filter_by(liker_id=g.user.id).delete()
-        db.session.delete(g.user)
+        user_id = g.user.id
+
+        # these users have the deleted user in their cached follows (the
+        # collections are already loaded on g.user)
+        related_ids = [u.id for u in g.user.followers + g.user.following]
+
+        # messages, follows and likes go with the user via ON DELETE CASCADE;
+        # in the same statement, delete likes of their messages explicitly
+        # so we learn who liked them (their cached likes are now stale)
+        likes_of_theirs = (delete(Likes)
+                           .where(Likes.message_id.in_(
+                               select(Message.id)
+                               .where(Message.user_id == user_id)))
+                           .returning(Likes.liker_id)
+                           .cte("likes_of_theirs"))
+        deleted_user = (delete(User)
+                        .where(User.id == user_id)
+                        .returning(User.id)
+                        .cte("deleted_user"))
+        liker_ids = db.session.scalars(
+            select(likes_of_theirs.c.liker_id)
+            .add_cte(deleted_user)).all()
         db.session.commit()
+
+        uncache_user(user_id, *related_ids, *liker_ids)
         flash("User successfully deleted :(", "warning")
 
     return redirect("/signup")
@@ -302,6 +408,7 @@ def messages_add():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
         db.session.commit()
+        uncache_user(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -313,7 +420,7 @@ def messages_show(message_id):
     """Show a message."""
 
     msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    return render_conditional('messages/show.html', message=msg)
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -325,10 +432,30 @@ def messages_destroy(message_id):
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        msg = Message.query.get(message_id)
-        db.session.delete(msg)
+        # one statement: delete the message if it's ours, and its likes,
+        # returning who liked it (their cached likes are now stale)
+        deleted_message = (delete(Message)
+                           .where(Message.id == message_id,
+                                  Message.user_id == g.user.id)
+                           .returning(Message.id)
+                           .cte("deleted_message"))
+        deleted_likes = (delete(Likes)
+                         .where(Likes.message_id.in_(
+                             select(deleted_message.c.id)))
+                         .returning(Likes.liker_id)
+                         .cte("deleted_likes"))
+        rows = db.session.execute(
+            select(deleted_message.c.id, deleted_likes.c.liker_id)
+            .select_from(deleted_message)
+            .outerjoin(deleted_likes, true())).all()
         db.session.commit()
-        flash("Your Warble has been deleted.", "warning")
+
+        if rows:
+            liker_ids = [row.liker_id for row in rows if row.liker_id]
+            uncache_user(g.user.id, *liker_ids)
+            flash("Your Warble has been deleted.", "warning")
+        else:
+            flash("Access unauthorized.", "danger")
 
     return redirect(f"/users/{g.user.id}")
 
@@ -356,10 +483,21 @@ def like_message(msg_id):
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        like = Likes(liker_id=g.user.id, message_id=msg_id)
-        db.session.add(like)
+        # only inserts if the message exists and isn't already liked
+        rows = db.session.execute(
+            insert(Likes)
+            .from_select(
+                ["liker_id", "message_id"],
+                select(literal(g.user.id), Message.id)
+                .where(Message.id == msg_id))
+            .on_conflict_do_nothing()).rowcount
         db.session.commit()
-        flash("Warble message liked!", "success")
+
+        if rows:
+            uncache_user(g.user.id)
+            flash("Warble message liked!", "success")
+        else:
+            flash("Warble message like unsuccessful.", "danger")
     else:
         flash("Warble message like unsuccessful.", "danger")
 
@@ -378,12 +516,13 @@ def unlike_message(msg_id):
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        like = Likes.query.filter_by(message_id=msg_id).filter_by(
-            liker_id=g.user.id).one_or_none()
+        rows = db.session.execute(
+            delete(Likes).where(Likes.liker_id == g.user.id,
+                                Likes.message_id == msg_id)).rowcount
+        db.session.commit()
 
-        if like:
-            db.session.delete(like)
-            db.session.commit()
+        if rows:
+            uncache_user(g.user.id)
             flash("You have unliked this post!", "warning")
     else:
         flash("Warble message unlike unsuccessful.", "danger")
@@ -406,42 +545,94 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: FEED_SIZE most recent messages of followed_users
+
+    Older pages are fetched by passing the last message seen as
+    ?before_ts=<timestamp>&before_id=<id> (keyset pagination, no OFFSET).
     """
 
     if g.user:
-        ids_for_feed = [g.user.id]
-
-        for person in g.user.following:
-            ids_for_feed.append(person.id)
-        # breakpoint()
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(ids_for_feed))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
+        before_ts = request.args.get('before_ts', type=datetime.fromisoformat)
+        before_id = request.args.get('before_id', type=int)
+
+        # let Postgres collect the followed ids rather than hydrating every
+        # followed User just to read its id
+        feed_user_ids = (select(Follows.user_being_followed_id.label('user_id'))
+                         .where(Follows.user_following_id == g.user.id)
+                         .union(select(literal(g.user.id)))
+                         .subquery())
+
+        # newest FEED_SIZE messages per feed user, each read in order off
+        # the messages_user_ts index, so the work is bounded no matter how
+        # much those users have posted over time
+        recent = (select(Message)
+                  .where(Message.user_id == feed_user_ids.c.user_id)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(FEED_SIZE))
+
+        if before_ts and before_id:
+            recent = recent.where(tuple_(Message.timestamp, Message.id)
+                                  < tuple_(before_ts, before_id))
+
+        recent = recent.lateral()
+        feed_message = aliased(Message, recent)
+
+        messages = (db.session
+                    .query(feed_message)
+                    .select_from(feed_user_ids)
+                    .join(recent, true())
+                    .options(selectinload(feed_message.user))
+                    .order_by(feed_message.timestamp.desc(),
+                              feed_message.id.desc())
+                    .limit(FEED_SIZE)
                     .all())
 
-        return render_template('home.html', messages=messages)
+        return render_template('home.html',
+                               messages=messages,
+                               page_size=FEED_SIZE)
 
     else:
-        return render_template('home-anon.html')
+        return render_conditional('home-anon.html')
 
 # TODO: WHY IN GOD'S NAME DOES EVERY CLICK IN THE MESSAGE BOX GO TO THE SAME PLACE?
 # EVEN WITH BUTTON ACTION EXPLICITLY NOT??? SO SIMILAR TO SOLUTION??
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Caching
+#   Pages seen by logged-in users (or carrying session changes) are never
+#   stored. Public pages rendered for anonymous visitors get an ETag so
+#   repeat visits can be answered with a 304.
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
 
+def render_conditional(template, **context):
+    """Render template; for anon visitors, tag it with an ETag and answer
+    with 304 Not Modified if the client already has this version."""
+
+    response = make_response(render_template(template, **context))
+
+    if not g.user:
+        response.add_etag()
+        response.make_conditional(request)
+
+    return response
+
+
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add caching headers on every request."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    # the same URL is cacheable or private depending on the session cookie
+    response.vary.add('Cookie')
+
+    etag, _ = response.get_etag()
+
+    if g.get('user') or session.modified or not etag:
+        response.cache_control.no_store = True
+    else:
+        # may be stored, but must be revalidated against the ETag each time
+        response.cache_control.no_cache = True
+
     return response
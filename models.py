@@ -3,10 +3,14 @@
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
+from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.orm import defer, selectinload
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
+cache = Cache()
 
 
 class Follows(db.Model):
@@ -53,7 +57,20 @@ class Message(db.Model):
         nullable=False,
     )
 
-    user = db.relationship('User')
+    # serves "newest messages by this user" (the homepage feed) in index
+    # order; id breaks timestamp ties for keyset pagination
+    __table_args__ = (
+        db.Index('messages_user_ts', user_id, timestamp.desc(), id.desc()),
+    )
+
+    user = db.relationship('User', back_populates='messages', lazy='select')
+
+    liking_users = db.relationship(
+        'User',
+        secondary='likes',
+        back_populates='liked_messages',
+        lazy='select',
+    )
 
 
 class Likes(db.Model):
@@ -61,25 +78,19 @@ class Likes(db.Model):
 
     __tablename__ = 'likes'
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True,
-        autoincrement=True
-    )
-
+    # composite pk: a user can like a given message only once
     liker_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id')
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id')
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
     )
 
-    # data model enables double likes, even if UI doesn't
-    # having a composite pk would prevent that (combo of two ids unique)
-
 
 
 class User(db.Model):
@@ -87,6 +98,16 @@ class User(db.Model):
 
     __tablename__ = 'users'
 
+    # trigram index so `ILIKE '%term%'` user searches don't seq-scan
+    __table_args__ = (
+        db.Index(
+            'users_username_trgm',
+            'username',
+            postgresql_using='gin',
+            postgresql_ops={'username': 'gin_trgm_ops'},
+        ),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -127,24 +148,31 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', order_by='Message.timestamp.desc()')
+    # lazy='select' everywhere so per-route selectinload/joinedload options
+    # decide how collections are loaded
+    messages = db.relationship(
+        'Message',
+        order_by='Message.timestamp.desc()',
+        back_populates='user',
+        lazy='select',
+    )
 
     liked_messages = db.relationship(
         'Message',
         secondary="likes",
-        primaryjoin=(id == Likes.liker_id),
-        secondaryjoin=(Likes.message_id == Message.id)
-        )
+        back_populates='liking_users',
+        lazy='select',
+    )
     # user and message L/R tables, not the same so they don't need primary
     # and secondary joins
-    # TODO: get rid of primary and secondary, add backref
-    # TODO: messages relationship, backref = liking_users
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        back_populates="following",
+        lazy="select",
     )
     # M:M user table is both left and right to follows table
     # requires both primary and secondary joins bc the computer doesn't know
@@ -155,7 +183,9 @@ class User(db.Model):
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        back_populates="followers",
+        lazy="select",
     )
 
     def __repr__(self):
@@ -175,6 +205,25 @@ class User(db.Model):
             user for user in self.following if user == other_user]
         return len(found_user_list) == 1
 
+    @classmethod
+    @cache.memoize(timeout=60)
+    def get_by_id(cls, user_id):
+        """Find user by id, with follows/followers/likes already loaded.
+
+        Memoized: after changing a user (or who they follow/like), call
+        cache.delete_memoized(User.get_by_id, User, user_id).
+        """
+
+        # selectinload (not joinedload) so the three collections don't
+        # multiply rows against each other; password hashes are deferred so
+        # they never end up in the cache
+        return db.session.get(cls, user_id, options=[
+            defer(cls.password),
+            selectinload(cls.following).defer(cls.password),
+            selectinload(cls.followers).defer(cls.password),
+            selectinload(cls.liked_messages),
+        ])
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -216,6 +265,14 @@ class User(db.Model):
         return False
 
 
+# the trigram index above needs pg_trgm available before the table is made
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'),
+)
+
+
 
 
 def connect_db(app):
@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, cache, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +21,16 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 from app import app, CURR_USER_KEY
 
+# Tests run in one process, so an in-process cache is safe (and lets us
+# test caching without Redis)
+
+cache.init_app(app, config={'CACHE_TYPE': 'SimpleCache'})
+
+# Flask-SQLAlchemy needs an app context for every db call; keep one
+# open for the whole test module
+
+app.app_context().push()
+
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -40,6 +50,7 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        cache.clear()
 
         self.client = app.test_client()
 
@@ -50,6 +61,19 @@ class MessageViewTestCase(TestCase):
 
         db.session.commit()
 
+    def add_other_users_message(self, text):
+        """Add a message by a second user; return the message id."""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        msg = Message(text=text, user=other)
+        db.session.add(msg)
+        db.session.commit()
+
+        return msg.id
+
     def test_add_message(self):
         """Can use add a message?"""
 
@@ -70,3 +94,138 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+
+    def test_delete_message(self):
+        """Can user delete their own message?"""
+
+        msg = Message(text="Goodbye", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/messages/{msg_id}/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(db.session.get(Message, msg_id))
+
+    def test_like_and_unlike_message(self):
+        """Can user like, then unlike, a message?"""
+
+        msg_id = self.add_other_users_message("Like me")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/like/{msg_id}", data={"came-from": "/"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Likes.query.count(), 1)
+
+            resp = c.post(f"/unlike/{msg_id}", data={"came-from": "/"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Likes.query.count(), 0)
+
+    def test_delete_liked_message_clears_likers_cache(self):
+        """Users who liked a deleted message don't keep it in their likes"""
+
+        testuser_id = self.testuser.id
+        liker = User.signup(username="liker",
+                            email="liker@test.com",
+                            password="likeruser",
+                            image_url=None)
+        msg = Message(text="Soon gone", user_id=testuser_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        liker_id = liker.id
+        db.session.add(Likes(liker_id=liker_id, message_id=msg_id))
+        db.session.commit()
+        db.session.remove()
+
+        # each request below starts from an empty db session, as it would
+        # outside of tests
+        with self.client as c:
+            # liker loads a page, caching their liked messages
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+            resp = c.get(f"/users/{liker_id}/liked_messages")
+            self.assertIn("Soon gone", resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post(f"/messages/{msg_id}/delete")
+
+            db.session.remove()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+            resp = c.get(f"/users/{liker_id}/liked_messages")
+            self.assertNotIn("Soon gone", resp.get_data(as_text=True))
+
+    def test_delete_other_users_message(self):
+        """Deleting someone else's message is refused"""
+
+        msg_id = self.add_other_users_message("Not yours")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/messages/{msg_id}/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNotNone(db.session.get(Message, msg_id))
+
+            with c.session_transaction() as sess:
+                self.assertIn(("danger", "Access unauthorized."),
+                              sess["_flashes"])
+
+    def test_like_message_twice(self):
+        """Liking an already-liked message doesn't add a second like"""
+
+        msg_id = self.add_other_users_message("Like me")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/like/{msg_id}", data={"came-from": "/"})
+            resp = c.post(f"/like/{msg_id}", data={"came-from": "/"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Likes.query.count(), 1)
+
+    def test_like_missing_message(self):
+        """Liking a message that doesn't exist adds nothing"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/like/99999", data={"came-from": "/"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Likes.query.count(), 0)
+
+            with c.session_transaction() as sess:
+                self.assertIn(("danger", "Warble message like unsuccessful."),
+                              sess["_flashes"])
+
+    def test_message_page_revalidates_for_anon(self):
+        """Anon message page keeps the same ETag, so repeat visits get 304"""
+
+        msg_id = self.add_other_users_message("Cache me")
+
+        # CSRF tokens are timestamped; with them on, any form rendered for
+        # an anon visitor would change the body (and the ETag) every time
+        app.config['WTF_CSRF_ENABLED'] = True
+        try:
+            with self.client as c:
+                resp = c.get(f"/messages/{msg_id}")
+                self.assertTrue(resp.cache_control.no_cache)
+
+                resp = c.get(f"/messages/{msg_id}",
+                             headers={"If-None-Match": resp.headers["ETag"]})
+                self.assertEqual(resp.status_code, 304)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
@@ -6,9 +6,14 @@
 
 
 import os
+from contextlib import contextmanager
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import raiseload, selectinload
+
+from models import db, cache, User, Message, Follows
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +24,17 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app
+from app import app, CURR_USER_KEY
+
+# Tests run in one process, so an in-process cache is safe (and lets us
+# test caching without Redis)
+
+cache.init_app(app, config={'CACHE_TYPE': 'SimpleCache'})
+
+# Flask-SQLAlchemy needs an app context for every db call; keep one
+# open for the whole test module
+
+app.app_context().push()
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -28,6 +43,22 @@ from app import app
 db.create_all()
 
 
+@contextmanager
+def count_queries():
+    """Collect every SQL statement sent to the db while inside the block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+
 class UserModelTestCase(TestCase):
     """Test views for messages."""
 
@@ -58,7 +89,20 @@ class UserModelTestCase(TestCase):
 
         self.u1_id = u1.id
         self.u2_id = u2.id
-        
+
+        cache.clear()
+
+    @contextmanager
+    def assert_max_queries(self, n):
+        """Fail if the block sends more than `n` SQL statements."""
+
+        with count_queries() as statements:
+            yield statements
+
+        self.assertLessEqual(
+            len(statements), n,
+            f"expected at most {n} queries, got {len(statements)}:\n"
+            + "\n".join(statements))
 
     def test_user_model(self):
         """Does basic model work?"""
@@ -121,3 +165,70 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(new_user.username, "lupa")
         self.assertIsInstance(new_user, User)
+
+    def test_get_by_id_does_not_cache_password(self):
+        """The cached current user carries no password hash"""
+
+        db.session.expunge_all()
+
+        User.get_by_id(self.u1_id)
+        db.session.expunge_all()
+        cached = User.get_by_id(self.u1_id)
+
+        # came back from the cache, not the session
+        self.assertNotIn(cached, db.session)
+        self.assertEqual(cached.id, self.u1_id)
+        self.assertNotIn("password", cached.__dict__)
+
+    ##############
+    # Query budgets: fail loudly if a refactor slips back into N+1
+
+    def test_is_following_without_lazy_loads(self):
+        """is_following should only need the `following` collection"""
+
+        db.session.add(Follows(
+            user_following_id=self.u1_id,
+            user_being_followed_id=self.u2_id
+        ))
+        db.session.commit()
+        db.session.expunge_all()
+
+        u1 = (User.query
+              .options(selectinload(User.following), raiseload("*"))
+              .filter_by(id=self.u1_id)
+              .one())
+        u2 = User.query.options(raiseload("*")).filter_by(id=self.u2_id).one()
+
+        self.assertTrue(u1.is_following(u2))
+        # anything not eager-loaded above must not be lazy-loaded
+        with self.assertRaises(InvalidRequestError):
+            u1.followers
+
+    def test_homepage_query_budget(self):
+        """Logged-in homepage stays within a fixed number of queries"""
+
+        db.session.add(Follows(
+            user_following_id=self.u1_id,
+            user_being_followed_id=self.u2_id
+        ))
+        db.session.add(Message(text="warble", user_id=self.u2_id))
+        db.session.commit()
+
+        # each request below starts from an empty db session, as it would
+        # outside of tests
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            # cold cache: user + 3 eager collections, feed + authors,
+            # g.user.messages for the sidebar count
+            db.session.remove()
+            with self.assert_max_queries(7):
+                resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+
+            # warm cache: g.user costs nothing
+            db.session.remove()
+            with self.assert_max_queries(3):
+                resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,290 @@
+"""User View tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_user_views.py
+
+
+import os
+import re
+from unittest import TestCase
+
+from models import db, cache, User, Follows, Message, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, FEED_SIZE
+
+# Tests run in one process, so an in-process cache is safe (and lets us
+# test caching without Redis)
+
+cache.init_app(app, config={'CACHE_TYPE': 'SimpleCache'})
+
+# Flask-SQLAlchemy needs an app context for every db call; keep one
+# open for the whole test module
+
+app.app_context().push()
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class UserViewTestCase(TestCase):
+    """Test views for users."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        cache.clear()
+
+        self.client = app.test_client()
+
+        u1 = User.signup(username="testuser1",
+                         email="test1@test.com",
+                         password="password1",
+                         image_url=None)
+        u2 = User.signup(username="testuser2",
+                         email="test2@test.com",
+                         password="password2",
+                         image_url=None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def login(self, c, user_id):
+        """Mimic logging in as `user_id` on test client `c`."""
+
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_add_follow(self):
+        """Can user follow another user?"""
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+
+            # warm the cached g.user, so the follow must invalidate it
+            c.get(f"/users/{self.u1_id}/following")
+
+            resp = c.post(f"/users/follow/{self.u2_id}",
+                          data={"came-from": "/"})
+            self.assertEqual(resp.status_code, 302)
+
+            follow = Follows.query.filter_by(
+                user_following_id=self.u1_id,
+                user_being_followed_id=self.u2_id).one_or_none()
+            self.assertIsNotNone(follow)
+
+            resp = c.get(f"/users/{self.u1_id}/following")
+            self.assertIn("@testuser2", resp.get_data(as_text=True))
+
+    def test_stop_following(self):
+        """Can user unfollow another user?"""
+
+        db.session.add(Follows(user_following_id=self.u1_id,
+                               user_being_followed_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.get(f"/users/{self.u1_id}/following")
+
+            resp = c.post(f"/users/stop-following/{self.u2_id}",
+                          data={"came-from": "/"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 0)
+
+            resp = c.get(f"/users/{self.u1_id}/following")
+            self.assertNotIn("@testuser2", resp.get_data(as_text=True))
+
+    def test_edit_profile(self):
+        """Can user update their profile?"""
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+
+            resp = c.post("/users/profile", data={
+                "username": "newname",
+                "email": "test1@test.com",
+                "bio": "a new bio",
+                "password": "password1",
+            })
+            self.assertEqual(resp.status_code, 302)
+
+            user = db.session.get(User, self.u1_id)
+            self.assertEqual(user.username, "newname")
+            self.assertEqual(user.bio, "a new bio")
+
+    def test_delete_user(self):
+        """Can user delete their account?"""
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/signup")
+            self.assertIsNone(db.session.get(User, self.u1_id))
+
+    def test_delete_user_clears_followers_cache(self):
+        """Followers of a deleted user don't keep seeing them"""
+
+        db.session.add(Follows(user_following_id=self.u2_id,
+                               user_being_followed_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            # u2 loads a page, caching their following list (with u1)
+            self.login(c, self.u2_id)
+            resp = c.get(f"/users/{self.u2_id}/following")
+            self.assertIn("@testuser1", resp.get_data(as_text=True))
+
+            self.login(c, self.u1_id)
+            c.post("/users/delete")
+
+            self.login(c, self.u2_id)
+            resp = c.get(f"/users/{self.u2_id}/following")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("@testuser1", resp.get_data(as_text=True))
+
+    def test_delete_user_clears_likers_cache(self):
+        """Users who liked a deleted user's messages don't keep them"""
+
+        msg = Message(text="Soon gone", user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add(Likes(liker_id=self.u2_id, message_id=msg.id))
+        db.session.commit()
+        db.session.remove()
+
+        # each request below starts from an empty db session, as it would
+        # outside of tests
+        with self.client as c:
+            self.login(c, self.u2_id)
+            resp = c.get(f"/users/{self.u2_id}/liked_messages")
+            self.assertIn("Soon gone", resp.get_data(as_text=True))
+
+            self.login(c, self.u1_id)
+            c.post("/users/delete")
+            db.session.remove()
+
+            self.login(c, self.u2_id)
+            resp = c.get(f"/users/{self.u2_id}/liked_messages")
+            self.assertNotIn("Soon gone", resp.get_data(as_text=True))
+
+    def test_homepage_cache_headers(self):
+        """Anon homepage is revalidated by ETag; logged-in one isn't stored"""
+
+        with self.client as c:
+            resp = c.get("/")
+            self.assertIsNotNone(resp.get_etag()[0])
+            self.assertTrue(resp.cache_control.no_cache)
+            self.assertIn("Cookie", resp.vary)
+
+            resp = c.get("/", headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+
+            self.login(c, self.u1_id)
+            resp = c.get("/")
+            self.assertTrue(resp.cache_control.no_store)
+            self.assertIn("Cookie", resp.vary)
+
+    def test_add_follow_twice(self):
+        """Following an already-followed user doesn't error or duplicate"""
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+
+            c.post(f"/users/follow/{self.u2_id}", data={"came-from": "/"})
+            resp = c.post(f"/users/follow/{self.u2_id}",
+                          data={"came-from": "/"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 1)
+
+    def test_add_follow_missing_user(self):
+        """Following a user that doesn't exist is a 404"""
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+
+            resp = c.post("/users/follow/99999", data={"came-from": "/"})
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(Follows.query.count(), 0)
+
+    def test_user_page_revalidates_for_anon(self):
+        """Anon profile page keeps the same ETag, so repeat visits get 304"""
+
+        # CSRF tokens are timestamped; with them on, any form rendered for
+        # an anon visitor would change the body (and the ETag) every time
+        db.session.add(Message(text="hello", user_id=self.u1_id))
+        db.session.commit()
+
+        app.config['WTF_CSRF_ENABLED'] = True
+        try:
+            with self.client as c:
+                resp = c.get(f"/users/{self.u1_id}")
+                self.assertTrue(resp.cache_control.no_cache)
+
+                resp = c.get(f"/users/{self.u1_id}",
+                             headers={"If-None-Match": resp.headers["ETag"]})
+                self.assertEqual(resp.status_code, 304)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_homepage_feed_with_self_follow(self):
+        """Following yourself doesn't duplicate your messages in the feed"""
+
+        db.session.add(Follows(user_following_id=self.u1_id,
+                               user_being_followed_id=self.u1_id))
+        db.session.add_all([
+            Message(text=f"warble {i}", user_id=self.u1_id)
+            for i in range(FEED_SIZE)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+
+            # duplicate feed rows would eat into the page and leave it short
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count('class="list-group-item"'), FEED_SIZE)
+
+    def test_homepage_older_warbles(self):
+        """A full feed page links to the next, older page"""
+
+        db.session.add_all([
+            Message(text=f"warble {i}", user_id=self.u1_id)
+            for i in range(FEED_SIZE + 1)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Older warbles", html)
+
+            older_url = re.search(r'href="(/\?before_ts=[^"]+)"', html)[1]
+            resp = c.get(older_url.replace("&amp;", "&"))
+            html = resp.get_data(as_text=True)
+            self.assertEqual(html.count('class="list-group-item"'), 1)
+            self.assertIn("warble 0", html)
+            self.assertNotIn("Older warbles", html)